@@ -1,19 +1,53 @@
+"""COSMO-CLM2 case classes
+
+Performance notes
+-----------------
+Setting up and chaining runs is I/O and latency bound, there is no numerical
+kernel in this package. Time goes into:
+- parsing namelists with f90nml (pure python tokenizer): namelists are parsed
+  once per process (see nmldict and _nml_cache), in parallel at case init, and
+  only written back if modified.
+- file system metadata operations and transfers on networked file systems:
+  directory creation, transfers and removals are batched and/or run concurrently.
+- date parsing/formatting: use tools.date_to_str rather than strftime.
+- small file rewrites (job scripts, xml configuration): build the content first,
+  write it once.
+Any vectorization or compiled code proposal should first be backed by a profile
+showing a compute bound hot spot.
+"""
+
 from __future__ import print_function
-from .tools import date_fmt, add_time_from_str, COSMO_input_file_name, indent_xml
-from subprocess import check_call, check_output
+from .tools import date_fmt, date_to_str, date_to_ymd, ymd_to_date, add_time_from_str, COSMO_input_file_name, indent_xml
+from subprocess import check_call, check_output, Popen, PIPE, CalledProcessError
 from argparse import ArgumentParser, RawTextHelpFormatter
 import f90nml
 from datetime import datetime, timedelta
 import os
-import re
+import copy
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 import xml.etree.ElementTree as ET
-from glob import glob
+from xml.sax.saxutils import escape
 import shutil
 import time
 import sys
 
 available_cases = {}
 
+# CESM components, each having its own modelio namelist and number of tasks
+_cesm_components = ('atm', 'cpl', 'glc', 'ice', 'lnd', 'ocn', 'rof', 'wav')
+
+# Namelists parsed in this process, stored as {abs_path: (mtime_ns, namelist)}
+_nml_cache = {}
+# Minimum number of namelists to parse for a process pool to pay off (typically at
+# install with all CESM modelio files). Forking and sending back the parsed namelists
+# costs more than parsing the few small files read by each run or transfer job.
+_nml_pool_min_files = 8
+
+# Minimum number of COSMO input files to check for listing the whole input directory
+# to be cheaper than checking each file (typically at install with transfer_all)
+_cos_in_scandir_min_files = 1000
+
 def factory(machine, **case_args):
     if machine not in available_cases:
         raise ValueError("machine {:s} not available".format(machine))
@@ -74,6 +108,7 @@ class cc2_case(object):
         self.start_mode = start_mode
         # Create namelists dictionnary
         self.nml = nmldict(self)
+        self._gribouts = None
         # Set install_dir and path
         self.install_dir = install_dir
         # Install: transfer namelists, executables and input files
@@ -81,6 +116,9 @@ class cc2_case(object):
             log = 'Setting up case {:s} in {:s}'.format(self.name, self._path)
             print(log + '\n' + '-' * len(log))
             self._install_case(cos_nml, cos_in, cos_exe, cos_rst, cesm_nml, cesm_in, cesm_exe, cesm_rst, oas_nml, oas_in)
+        # Read needed namelists concurrently
+        self.nml.prefetch(self._nml_files())
+        if self.install:
             self._create_missing_dirs()
         self.cos_exe = cos_exe
         if not self.cosmo_only:
@@ -128,7 +166,7 @@ class cc2_case(object):
     def install_dir(self, ins_dir):
         if ins_dir is None:
             if self._default_install_dir is None:
-                raise NotImplementedError("_default_install_dir class variable not set for Class {:s}".format(cls.__name__))
+                raise NotImplementedError("_default_install_dir class variable not set for Class {:s}".format(self.__class__.__name__))
             else:
                 self._install_dir = self._default_install_dir
         else:
@@ -149,7 +187,7 @@ class cc2_case(object):
     def start_date(self, start_date):
         if start_date is not None:
             self._start_date = datetime.strptime(start_date, date_fmt['in'])
-            self.nml['INPUT_ORG']['runctl']['ydate_ini'] = self._start_date.strftime(date_fmt['cosmo'])
+            self.nml['INPUT_ORG']['runctl']['ydate_ini'] = date_to_str(self._start_date, 'cosmo')
         elif 'ydate_ini' in self.nml['INPUT_ORG']['runctl']:
             self._start_date = datetime.strptime(self.nml['INPUT_ORG']['runctl']['ydate_ini'],
                                                  date_fmt['cosmo'])
@@ -173,7 +211,7 @@ class cc2_case(object):
     def end_date(self, end_date):
         if end_date is not None:
             self._end_date = datetime.strptime(end_date, date_fmt['in'])
-            self.nml['INPUT_ORG']['runctl']['ydate_end'] = self._end_date.strftime(date_fmt['cosmo'])
+            self.nml['INPUT_ORG']['runctl']['ydate_end'] = date_to_str(self._end_date, 'cosmo')
         elif 'ydate_end' in self.nml['INPUT_ORG']['runctl']:
             self._end_date = datetime.strptime(self.nml['INPUT_ORG']['runctl']['ydate_end'], date_fmt['cosmo'])
         else:
@@ -185,9 +223,7 @@ class cc2_case(object):
         return int(status_node.find('cos_in_file_size').text)
     @cos_in_file_size.setter
     def cos_in_file_size(self, sz):
-        tree = ET.parse(os.path.join(self.path, self._xml_config))
-        tree.find('status').find('cos_in_file_size').text = str(sz)
-        tree.write(os.path.join(self.path, self._xml_config), xml_declaration=True)
+        self._update_xml_config({'status/cos_in_file_size': str(sz)})
 
     @property
     def run_status(self):
@@ -195,9 +231,7 @@ class cc2_case(object):
         return status_node.find('run_status').text
     @run_status.setter
     def run_status(self, status):
-        tree = ET.parse(os.path.join(self.path, self._xml_config))
-        tree.find('status').find('run_status').text = status
-        tree.write(os.path.join(self.path, self._xml_config), xml_declaration=True)
+        self._update_xml_config({'status/run_status': status})
 
     @property
     def transfer_status(self):
@@ -205,19 +239,45 @@ class cc2_case(object):
         return status_node.find('transfer_status').text
     @transfer_status.setter
     def transfer_status(self, status):
+        self._update_xml_config({'status/transfer_status': status})
+
+
+    def _write_xml_config(self, config):
+        """Write case xml configuration, given as an ElementTree or a string,
+        atomically replacing the existing one"""
+
+        path = os.path.join(self.path, self._xml_config)
+        # Process specific temporary file so that concurrent writers don't clobber each other
+        tmp_path = '{:s}.{:d}.tmp'.format(path, os.getpid())
+        try:
+            if isinstance(config, str):
+                with open(tmp_path, mode='w', encoding='utf-8') as f:
+                    f.write(config)
+            else:
+                # End the file with a newline
+                config.getroot().tail = '\n'
+                config.write(tmp_path, xml_declaration=True)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+    def _update_xml_config(self, values):
+        """Set text of case xml configuration nodes given as {path: text} in one read/write cycle
+
+        The file is read again each time as the transfer job modifies it as well."""
+
         tree = ET.parse(os.path.join(self.path, self._xml_config))
-        tree.find('status').find('transfer_status').text = status
-        tree.write(os.path.join(self.path, self._xml_config), xml_declaration=True)
+        for node_path, text in values.items():
+            tree.find(node_path).text = text
+        self._write_xml_config(tree)
 
 
     def _install_case(self, cos_nml, cos_in, cos_exe, cos_rst, cesm_nml, cesm_in, cesm_exe, cesm_rst, oas_nml, oas_in):
 
-        def _transfer(origin, target=None, folder=True, command='rsync'):
-            # command
-            if command == 'rsync':
-                cmd = 'rsync -avL --exclude=".*"'
-            elif command == 'ln':
-                cmd = 'ln -sf'
+        def _transfer_cmd(origin, target=None, folder=True, command='rsync'):
             # origin
             if folder:
                 if command == 'rsync':
@@ -228,10 +288,28 @@ class cc2_case(object):
                 org = os.path.abspath(origin)
             # target
             trg = self.path if target is None else os.path.join(self.path, target)
-            # transfer
-            cmd_run = '{:s} {:s} {:s}'.format(cmd, org, trg)
-            print(cmd_run)
-            check_call(cmd_run, shell=True)
+            return command, org, trg
+
+        def _transfer(*transfers):
+            # Transfers to the same target directory run in order, transfers to
+            # different targets run concurrently. rsync is then kept quiet so that
+            # the file lists of concurrent transfers don't get interleaved.
+            groups = {}
+            for transfer in transfers:
+                groups.setdefault(os.path.normpath(transfer[2]), []).append(transfer)
+            rsync_opts = '-avL' if len(groups) == 1 else '-aL'
+
+            def _run(group):
+                for command, org, trg in group:
+                    if command == 'rsync':
+                        cmd = 'rsync {:s} --exclude=".*" {:s} {:s}'.format(rsync_opts, org, trg)
+                    elif command == 'ln':
+                        cmd = 'ln -sf {:s} {:s}'.format(org, trg)
+                    print(cmd)
+                    check_call(cmd, shell=True)
+
+            with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+                list(executor.map(_run, groups.values()))
 
 
         if not os.path.exists(self.path):
@@ -241,34 +319,39 @@ class cc2_case(object):
         # Transfer everything except COSMO input files
         input_cmd = 'ln' if self.input_type == 'symlink' else 'rsync'
         self._mk_miss_path('CESM_input')
-        _transfer(cos_nml)
-        _transfer(cos_exe, folder=False)
+        transfer_cmds = [_transfer_cmd(cos_nml), _transfer_cmd(cos_exe, folder=False)]
         if not self.cosmo_only:
-            _transfer(cesm_nml)
-            _transfer(cesm_exe, folder=False)
-            _transfer(cesm_in, target='CESM_input', command=input_cmd)
-            _transfer(oas_nml)
+            transfer_cmds += [_transfer_cmd(cesm_nml),
+                              _transfer_cmd(cesm_exe, folder=False),
+                              _transfer_cmd(cesm_in, target='CESM_input', command=input_cmd),
+                              _transfer_cmd(oas_nml)]
             if not self.gen_oasis:
-                _transfer(oas_in, command=input_cmd)
-            else:
-                print('generate OASIS file:')
-                for f in os.listdir(oas_in):
-                    try:
-                        print('   removing ' +  os.path.join(self.path, f))
-                        os.remove(os.path.join(self.path, f))
-                    except OSError:
-                        pass
+                transfer_cmds.append(_transfer_cmd(oas_in, command=input_cmd))
+        _transfer(*transfer_cmds)
+        if not self.cosmo_only and self.gen_oasis:
+            print('generate OASIS file:')
+            def _remove(path):
+                try:
+                    os.remove(path)
+                except OSError:   # missing file or directory
+                    pass
+            paths = [os.path.join(self.path, f) for f in os.listdir(oas_in)]
+            for path in paths:
+                print('   removing ' + path)
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                list(executor.map(_remove, paths))
 
         if self.start_mode != 'startup':
-            if 'ydir_restart_in' in self.nml['INPUT_IO']['ioctl']:
-                cos_rst_nml = self.nml['INPUT_IO']['ioctl']['ydir_restart_in']
-            elif 'ydir_restart' in  self.nml['INPUT_IO']['ioctl']:
-                cos_rst_nml = self.nml['INPUT_IO']['ioctl']['ydir_restart']
+            ioctl = self.nml['INPUT_IO']['ioctl']
+            if 'ydir_restart_in' in ioctl:
+                cos_rst_nml = ioctl['ydir_restart_in']
+            elif 'ydir_restart' in ioctl:
+                cos_rst_nml = ioctl['ydir_restart']
             else:
                 cos_rst_nml = ''
             self._mk_miss_path(cos_rst_nml)
             cos_rst_target = os.path.normpath(os.path.join(self.path, cos_rst_nml, os.path.basename(cos_rst)))
-            _transfer(cos_rst, target=cos_rst_nml, folder=False)
+            _transfer(_transfer_cmd(cos_rst, target=cos_rst_nml, folder=False))
 
             if cos_rst.endswith('.gz'):
                 check_call(['gunzip', cos_rst_target])
@@ -292,25 +375,32 @@ class cc2_case(object):
 
     def _set_nml_start_parameters(self):
 
+        # Access to namelists
+        runctl = self.nml['INPUT_ORG']['runctl']
+        if not self.cosmo_only:
+            timemgr = self.nml['drv_in']['seq_timemgr_inparm']
+            infodata = self.nml['drv_in']['seq_infodata_inparm']
+            clm_inparm = self.nml['lnd_in']['clm_inparm']
+
         if self.start_mode == 'startup':
-            self.nml['INPUT_ORG']['runctl']['hstart'] = 0
+            runctl['hstart'] = 0
             if not self.cosmo_only:
-                self.nml['drv_in']['seq_timemgr_inparm']['start_ymd'] = int(self.start_date.strftime(date_fmt['cesm']))
-                self.nml['drv_in']['seq_infodata_inparm']['start_type'] = 'startup'
-                if 'nrevsn' in self.nml['lnd_in']['clm_inparm']:
-                    del(self.nml['lnd_in']['clm_inparm']['nrevsn'])
+                timemgr['start_ymd'] = date_to_ymd(self.start_date)
+                infodata['start_type'] = 'startup'
+                if 'nrevsn' in clm_inparm:
+                    del(clm_inparm['nrevsn'])
         else:
-            self.nml['INPUT_ORG']['runctl']['hstart'] = (self.restart_date - self.start_date).total_seconds() // 3600.0
+            runctl['hstart'] = (self.restart_date - self.start_date).total_seconds() // 3600.0
             if not self.cosmo_only:
-                self.nml['drv_in']['seq_timemgr_inparm']['start_ymd'] = int(self.restart_date.strftime(date_fmt['cesm']))
+                timemgr['start_ymd'] = date_to_ymd(self.restart_date)
                 if self.start_mode == 'continue':
-                    self.nml['drv_in']['seq_infodata_inparm']['start_type'] = 'continue'
-                    if 'nrevsn' in self.nml['lnd_in']['clm_inparm']:
-                        del(self.nml['lnd_in']['clm_inparm']['nrevsn'])
+                    infodata['start_type'] = 'continue'
+                    if 'nrevsn' in clm_inparm:
+                        del(clm_inparm['nrevsn'])
                 elif self.start_mode == 'restart':
-                    self.nml['drv_in']['seq_infodata_inparm']['start_type'] = 'branch'
+                    infodata['start_type'] = 'branch'
                     with open(os.path.join(self.path, 'rpointer.lnd')) as rpt:
-                        self.nml['lnd_in']['clm_inparm']['nrevsn'] = rpt.readline().strip()
+                        clm_inparm['nrevsn'] = rpt.readline().strip()
 
 
     def _cos_input_delta_ext(self):
@@ -319,45 +409,104 @@ class cc2_case(object):
         delta = timedelta(hours=self.nml['INPUT_IO']['gribin']['hincbound'])
         # Set file extension
         ext = ''
-        if 'yform_read' in self.nml['INPUT_IO']['ioctl']:
-            if self.nml['INPUT_IO']['ioctl']['yform_read'] == 'ncdf':
+        ioctl = self.nml['INPUT_IO']['ioctl']
+        if 'yform_read' in ioctl:
+            if ioctl['yform_read'] == 'ncdf':
                 ext = '.nc'
         return delta, ext
 
 
-    def build_transfer_list(self, start_date, end_date, initial=False):
+    def _cos_input_file_names(self, start_date, end_date, initial=False):
+        """List of COSMO boundary files from start_date to end_date (initial file first if required)"""
 
         delta, ext = self._cos_input_delta_ext()
+        file_root = 'laf' if self.nml['INPUT_IO']['gribin']['lbdana'] else 'lbfd'
+        file_names = [COSMO_input_file_name(file_root, start_date + k * delta, ext)
+                      for k in range((end_date - start_date) // delta + 1)]
+        if initial:
+            file_names.insert(0, COSMO_input_file_name('laf', start_date, ext))
+        return file_names
+
 
-        # function to check and add file to transfer list or directly symlink
-        def _check_add_file(root, date, file_list):
-            file_name = COSMO_input_file_name(root, date, ext)
-            if os.path.exists(os.path.join(self.cos_in, file_name)):
+    def _prepare_input_files(self, start_date, end_date, initial=False):
+        """Check COSMO input files and symlink them or return the list of those to transfer"""
+
+        input_files = self._cos_input_file_names(start_date, end_date, initial=initial)
+        if len(input_files) >= _cos_in_scandir_min_files:
+            # List input directory once instead of checking each file
+            with os.scandir(self.cos_in) as entries:
+                present = {entry.name for entry in entries if entry.is_file()}
+        else:
+            present = {file_name for file_name in input_files
+                       if os.path.isfile(os.path.join(self.cos_in, file_name))}
+
+        file_names = []
+        for file_name in input_files:
+            if file_name in present:
                 if self.input_type == 'symlink':
                     print(file_name)
                     check_call(['ln', '-sf', os.path.join(self.cos_in, file_name),
                                 os.path.join(self.path,'COSMO_input')])
                 elif self.input_type == 'file':
-                    file_list.write(file_name + '\n')
+                    file_names.append(file_name)
             else:
                 raise ValueError("input file {:s} is missing from {:s}".format(file_name, self.cos_in))
+        return file_names
+
+
+    def build_transfer_list(self, start_date, end_date, initial=False):
 
         # Build file list to transfer or symlink
+        file_names = self._prepare_input_files(start_date, end_date, initial=initial)
         with open(self._transfer_list, mode ='w') as t_list:
-            if initial:
-                _check_add_file('laf', start_date, t_list)
-            cur_date = start_date
-            file_root = 'laf' if self.nml['INPUT_IO']['gribin']['lbdana'] else 'lbfd'
-            while cur_date <= end_date:
-                _check_add_file(file_root, cur_date, t_list)
-                cur_date += delta
+            t_list.writelines(file_name + '\n' for file_name in file_names)
 
 
-    def transfer_input(self):
+    def transfer_input(self, file_names=None):
+        """Transfer COSMO input files given as a list or read from the transfer list file"""
 
         if self.input_type == 'file':
-            check_call(['rsync', '-avL', '--files-from', self._transfer_list,
-                        self.cos_in, os.path.join(self.path,'COSMO_input')])
+            if file_names is None:
+                with open(self._transfer_list) as t_list:
+                    file_names = t_list.read().split()
+            # Split files across several rsync processes as a single one is limited by
+            # its file list handling. Whole file copies: target files are new,
+            # the delta algorithm is useless. Report transfer statistics rather than
+            # every file name, and overall progress only for a single rsync as the
+            # progress lines of concurrent processes would overwrite each other.
+            n_proc = max(1, min(len(file_names), multiprocessing.cpu_count(), 8))
+            info = '--info=progress2,stats2' if n_proc == 1 else '--info=stats2'
+            cmd = ['rsync', '-aLW', '--inplace', info, '--files-from=-',
+                   self.cos_in, os.path.join(self.path,'COSMO_input')]
+            procs = []
+            try:
+                for k in range(n_proc):
+                    proc = Popen(cmd, stdin=PIPE, universal_newlines=True)
+                    procs.append(proc)
+                    try:
+                        proc.stdin.write('\n'.join(file_names[k::n_proc]) + '\n')
+                        proc.stdin.close()
+                    except BrokenPipeError:
+                        # rsync exited early, its return code is reported below
+                        pass
+                for k, proc in enumerate(procs):
+                    proc.wait()
+                    if n_proc > 1:
+                        print('COSMO input transfer {:d}/{:d} ({:d} files) exited with status {:d}'.format(
+                            k+1, n_proc, len(file_names[k::n_proc]), proc.returncode))
+            finally:
+                # Don't leave rsync processes behind if anything went wrong
+                for proc in procs:
+                    try:
+                        proc.stdin.close()
+                    except BrokenPipeError:
+                        pass
+                    if proc.poll() is None:
+                        proc.terminate()
+                        proc.wait()
+            for proc in procs:
+                if proc.returncode != 0:
+                    raise CalledProcessError(proc.returncode, cmd)
 
 
     def _install_input(self):
@@ -375,12 +524,10 @@ class cc2_case(object):
         # Transfer first chunck input files or all
         initial = self.start_mode == 'startup'
         if self.transfer_by_chunck and self._run_end_date < self.end_date:
-            self.build_transfer_list(self._run_start_date, self._run_end_date, initial=initial)
+            end_date = self._run_end_date
         else:
             end_date = self.end_date + timedelta(days=1) if self.dummy_day else self.end_date
-            self.build_transfer_list(self._run_start_date, end_date, initial=initial)
-        self.transfer_input()
-        os.remove(self._transfer_list)
+        self.transfer_input(self._prepare_input_files(self._run_start_date, end_date, initial=initial))
 
         # Set transfer status
         self.transfer_status = 'complete'
@@ -388,41 +535,37 @@ class cc2_case(object):
 
     def _check_COSMO_input(self, start_date, end_date):
 
-        delta, ext = self._cos_input_delta_ext()
-        cur_date = start_date
         cos_in_file_size = self.cos_in_file_size # get from xml once for all
-        file_root = 'laf' if self.nml['INPUT_IO']['gribin']['lbdana'] else 'lbfd'
-        while cur_date <= end_date:
-            file_name = COSMO_input_file_name(file_root, cur_date, ext)
-            file_path = os.path.join(self.path, 'COSMO_input', file_name)
-            if not os.path.exists(file_path):
+        for file_name in self._cos_input_file_names(start_date, end_date):
+            try:
+                fs = os.stat(os.path.join(self.path, 'COSMO_input', file_name)).st_size
+            except FileNotFoundError:
                 raise ValueError("COSMO input file {:s} missing".format(file_name))
-            fs = os.stat(file_path).st_size
             if fs != cos_in_file_size:
                 err_mess = "COSMO input file {:s} has byte size {:d} instead of {:d}"
                 raise ValueError(err_mess.format(file_name, fs, cos_in_file_size))
-            cur_date += delta
 
 
     def _organize_tasks(self, ncosx, ncosy, ncosio, ncesm):
 
         # COSMO tasks
         # -----------
+        runctl = self.nml['INPUT_ORG']['runctl']
         if ncosx is None:
-            self._ncosx = self.nml['INPUT_ORG']['runctl']['nprocx']
+            self._ncosx = runctl['nprocx']
         else:
             self._ncosx = ncosx
-            self.nml['INPUT_ORG']['runctl']['nprocx'] = ncosx
+            runctl['nprocx'] = ncosx
         if ncosy is None:
-            self._ncosy = self.nml['INPUT_ORG']['runctl']['nprocy']
+            self._ncosy = runctl['nprocy']
         else:
             self._ncosy = ncosy
-            self.nml['INPUT_ORG']['runctl']['nprocy'] = ncosy
+            runctl['nprocy'] = ncosy
         if ncosio is None:
-            self._ncosio = self.nml['INPUT_ORG']['runctl']['nprocio']
+            self._ncosio = runctl['nprocio']
         else:
             self._ncosio = ncosio
-            self.nml['INPUT_ORG']['runctl']['nprocio'] = ncosio
+            runctl['nprocio'] = ncosio
         self._ncos = self._ncosx * self._ncosy + self._ncosio
 
         # CESM tasks and number of nodes
@@ -434,10 +577,11 @@ class cc2_case(object):
             else:
                 self._n_nodes = self._ncos // self._n_tasks_per_node
         else:
-            if 'ccsm_pes' in self.nml['drv_in']:
-                pes_nml = self.nml['drv_in']['ccsm_pes']
+            drv_in = self.nml['drv_in']
+            if 'ccsm_pes' in drv_in:
+                pes_nml = drv_in['ccsm_pes']
             else:
-                pes_nml = self.nml['drv_in']['cime_pes']
+                pes_nml = drv_in['cime_pes']
             if self.gpu_mode:   # Populate nodes with CESM tasks except one
                 self._n_nodes = self._ncos
                 self._ncesm = self._n_nodes * (self._n_tasks_per_node - 1)
@@ -452,8 +596,8 @@ class cc2_case(object):
                     raise ValueError(msg.format(ntot, self._n_tasks_per_node))
                 self._n_nodes = ntot // self._n_tasks_per_node
             # Apply number of CESM tasks to all relevant namelist parameters
-            for comp in ['atm', 'cpl', 'glc', 'ice', 'lnd', 'ocn', 'rof', 'wav']:
-                pes_nml['{:s}_ntasks'.format(comp)] = self._ncesm
+            for comp in _cesm_components:
+                pes_nml[comp + '_ntasks'] = self._ncesm
             if self.gen_oasis:
                 pes_nml['atm_ntasks'] = 1
 
@@ -462,15 +606,15 @@ class cc2_case(object):
 
         # Access to namelists
         # -------------------
-        INPUT_ORG = self.nml['INPUT_ORG']
+        runctl = self.nml['INPUT_ORG']['runctl']
         if not self.cosmo_only:
-            drv_in = self.nml['drv_in']
+            timemgr = self.nml['drv_in']['seq_timemgr_inparm']
 
         # Read in _run_start_date
         # -----------------------
-        date_cosmo = self._start_date + timedelta(hours=INPUT_ORG['runctl']['hstart'])
+        date_cosmo = self._start_date + timedelta(hours=runctl['hstart'])
         if not self.cosmo_only:
-            date_cesm = datetime.strptime(str(drv_in['seq_timemgr_inparm']['start_ymd']), date_fmt['cesm'])
+            date_cesm = ymd_to_date(timemgr['start_ymd'])
             if date_cosmo != date_cesm:
                 raise ValueError("start dates are not identical in COSMO and CESM namelists")
         self._run_start_date = date_cosmo
@@ -489,10 +633,9 @@ class cc2_case(object):
                 self._runtime = self._run_end_date - self._run_start_date
         else:
             if self.run_length is None:
-                runtime_cosmo = (INPUT_ORG['runctl']['nstop'] + 1) * INPUT_ORG['runctl']['dt'] \
-                                - INPUT_ORG['runctl']['hstart'] * 3600.0
+                runtime_cosmo = (runctl['nstop'] + 1) * runctl['dt'] - runctl['hstart'] * 3600.0
                 if not self.cosmo_only:
-                    runtime_cesm = drv_in['seq_timemgr_inparm']['stop_n']
+                    runtime_cesm = timemgr['stop_n']
                     if runtime_cosmo != runtime_cesm:
                         raise ValueError("run lengths are not identical in COSMO and CESM namelists")
                 self._runtime = timedelta(seconds=runtime_cosmo)
@@ -513,14 +656,14 @@ class cc2_case(object):
     def _apply_run_dates(self):
 
         # Access to namelists
-        INPUT_ORG = self.nml['INPUT_ORG']
-        INPUT_IO = self.nml['INPUT_IO']
+        runctl = self.nml['INPUT_ORG']['runctl']
+        ioctl = self.nml['INPUT_IO']['ioctl']
         if not self.cosmo_only:
-            drv_in = self.nml['drv_in']
+            timemgr = self.nml['drv_in']['seq_timemgr_inparm']
 
         # Compute times
         start_seconds = (self._run_start_date - self.start_date).total_seconds()
-        dt = INPUT_ORG['runctl']['dt']
+        dt = runctl['dt']
         runtime_seconds = self._runtime.total_seconds()
         runtime_hours = runtime_seconds // 3600
 
@@ -535,9 +678,9 @@ class cc2_case(object):
 
 
         # adapt INPUT_ORG
-        if 'hstop' in INPUT_ORG['runctl']:
-            del INPUT_ORG['runctl']['hstop']
-        INPUT_ORG['runctl']['nstop'] = nstop - 1
+        if 'hstop' in runctl:
+            del runctl['hstop']
+        runctl['nstop'] = nstop - 1
 
         # adapt INPUT_IO
         for gribout in self._get_gribouts():
@@ -545,24 +688,24 @@ class cc2_case(object):
                 gribout['hcomb'][0:2] = hstart, hstop
             elif 'ncomb' in gribout:
                 gribout['ncomb'][0:2] = nstart, nstop
-        INPUT_IO['ioctl']['nhour_restart'] = [nhour_restart, nhour_restart, 24]
+        ioctl['nhour_restart'] = [nhour_restart, nhour_restart, 24]
 
         if not self.cosmo_only:
             # adapt drv_in
-            drv_in['seq_timemgr_inparm']['stop_n'] = int(runtime_seconds)
-            drv_in['seq_timemgr_inparm']['stop_option'] = 'nseconds'
-            drv_in['seq_timemgr_inparm']['calendar'] = 'GREGORIAN'
-            drv_in['seq_timemgr_inparm']['restart_option'] = 'nseconds'
+            timemgr['stop_n'] = int(runtime_seconds)
+            timemgr['stop_option'] = 'nseconds'
+            timemgr['calendar'] = 'GREGORIAN'
+            timemgr['restart_option'] = 'nseconds'
             if self._run_end_date > self.end_date:
                 # ensure restart for the real end date, not after the dummy day
-                drv_in['seq_timemgr_inparm']['restart_n'] = int(runtime_seconds)-86400
+                timemgr['restart_n'] = int(runtime_seconds)-86400
             else:
-                drv_in['seq_timemgr_inparm']['restart_n'] = int(runtime_seconds)
+                timemgr['restart_n'] = int(runtime_seconds)
 
             # adapt namcouple
             with open(os.path.join(self.path, 'namcouple_tmpl'), mode='r') as f:
                 content = f.read()
-            content = re.sub('_runtime_', str(int(runtime_seconds)), content)
+            content = content.replace('_runtime_', str(int(runtime_seconds)))
             with open(os.path.join(self.path, 'namcouple'), mode='w') as f:
                 f.write(content)
 
@@ -580,8 +723,9 @@ class cc2_case(object):
     def _check_INPUT_IO(self):
 
         # Make sure COSMO input and initial files are looked for in the COSMO_input folder
-        self.nml['INPUT_IO']['gribin']['ydirini'] = 'COSMO_input'
-        self.nml['INPUT_IO']['gribin']['ydirbd'] = 'COSMO_input'
+        gribin = self.nml['INPUT_IO']['gribin']
+        gribin['ydirini'] = 'COSMO_input'
+        gribin['ydirbd'] = 'COSMO_input'
 
         # Only keep gribout blocks that fit within runtime
         # (essentially to avoid crash for short tests)
@@ -603,17 +747,32 @@ class cc2_case(object):
         else:
             if gribouts_in:
                 del self.nml['INPUT_IO']['gribout']
+        self._gribouts = None
 
 
     def _get_gribouts(self):
+        """Return the list of gribout blocks of INPUT_IO
+
+        The list is cached, set self._gribouts to None after adding or removing blocks."""
+
+        if self._gribouts is None:
+            INPUT_IO = self.nml['INPUT_IO']
+            if 'gribout' not in INPUT_IO:
+                self._gribouts = []
+            else:
+                gribouts = INPUT_IO['gribout']
+                self._gribouts = gribouts if isinstance(gribouts, list) else [gribouts]
+        return self._gribouts
 
-        if 'gribout' not in self.nml['INPUT_IO'].keys():
-            return []
-        else:
-            gribouts = self.nml['INPUT_IO']['gribout']
-            if not isinstance(gribouts, list):
-                gribouts = [gribouts]
-            return gribouts
+
+    def _nml_files(self):
+
+        names = ['INPUT_ORG', 'INPUT_IO']
+        if not self.cosmo_only:
+            names += ['drv_in', 'lnd_in']
+            if self.install:
+                names += [comp + '_modelio.nml' for comp in _cesm_components]
+        return names
 
 
     def write_open_nml(self):
@@ -622,93 +781,112 @@ class cc2_case(object):
 
     def _create_missing_dirs(self):
 
+        rel_paths = set()
+
         # COSMO
         # -----
         # input
-        self._mk_miss_path(self.nml['INPUT_IO']['gribin']['ydirini'])
-        self._mk_miss_path(self.nml['INPUT_IO']['gribin']['ydirbd'])
+        gribin = self.nml['INPUT_IO']['gribin']
+        ioctl = self.nml['INPUT_IO']['ioctl']
+        rel_paths.add(gribin['ydirini'])
+        rel_paths.add(gribin['ydirbd'])
         # output
         for gribout in self._get_gribouts():
-            self._mk_miss_path(gribout['ydir'])
-        if 'ydir_restart' in self.nml['INPUT_IO']['ioctl']:
-            self._mk_miss_path(self.nml['INPUT_IO']['ioctl']['ydir_restart'])
-        if 'ydir_restart_in' in self.nml['INPUT_IO']['ioctl']:
-            self._mk_miss_path(self.nml['INPUT_IO']['ioctl']['ydir_restart_in'])
-        if 'ydir_restart_out' in self.nml['INPUT_IO']['ioctl']:
-            self._mk_miss_path(self.nml['INPUT_IO']['ioctl']['ydir_restart_out'])
+            rel_paths.add(gribout['ydir'])
+        for key in ['ydir_restart', 'ydir_restart_in', 'ydir_restart_out']:
+            if key in ioctl:
+                rel_paths.add(ioctl[key])
 
         # CESM
         # ----
         if not self.cosmo_only:
             # timing
             # remove if exists before creating
-            shutil.rmtree(os.path.join(self.path, self.nml['drv_in']['seq_infodata_inparm']['timing_dir']),
-                          ignore_errors=True)
-            shutil.rmtree(os.path.join(self.path, self.nml['drv_in']['seq_infodata_inparm']['tchkpt_dir']),
-                          ignore_errors=True)
-            self._mk_miss_path(self.nml['drv_in']['seq_infodata_inparm']['timing_dir'])
-            self._mk_miss_path(self.nml['drv_in']['seq_infodata_inparm']['tchkpt_dir'])
+            infodata = self.nml['drv_in']['seq_infodata_inparm']
+            timing_dirs = [infodata['timing_dir'], infodata['tchkpt_dir']]
+            with ThreadPoolExecutor(max_workers=len(timing_dirs)) as executor:
+                list(executor.map(lambda d: shutil.rmtree(os.path.join(self.path, d), ignore_errors=True),
+                                  timing_dirs))
+            rel_paths.update(timing_dirs)
             # input / output
-            for comp in ['atm', 'cpl', 'glc', 'ice', 'lnd', 'ocn', 'rof', 'wav']:
-                self._mk_miss_path(self.nml['{:s}_modelio.nml'.format(comp)]['modelio']['diri'])
-                self._mk_miss_path(self.nml['{:s}_modelio.nml'.format(comp)]['modelio']['diro'])
+            for comp in _cesm_components:
+                modelio = self.nml[comp + '_modelio.nml']['modelio']
+                rel_paths.add(modelio['diri'])
+                rel_paths.add(modelio['diro'])
+
+        # Create all directories, normalizing to avoid duplicates
+        for path in sorted(set(os.path.normpath(os.path.join(self.path, p)) for p in rel_paths)):
+            self._mk_miss_path(path)
 
 
     def _mk_miss_path(self, rel_path):
 
         path = os.path.join(self.path, rel_path)
-        if not os.path.exists(path):
-            print('Creating path ' + path)
+        # Don't check existence beforehand, this saves one stat per path
+        try:
             os.makedirs(path)
+        except FileExistsError:
+            pass
+        else:
+            print('Creating path ' + path)
 
 
     def to_xml(self):
 
-        config_node = ET.Element('config')
-        tree = ET.ElementTree(config_node)
-        ET.SubElement(config_node, 'machine').text = self._target_machine
-
-        main_node = ET.SubElement(config_node, 'main')
-        ET.SubElement(main_node, 'name').text = self.name
-        ET.SubElement(main_node, 'install_dir').text = self.install_dir
-        ET.SubElement(main_node, 'cosmo_only', type='py_eval').text = str(self.cosmo_only)
-        ET.SubElement(main_node, 'gen_oasis', type='py_eval').text = str(self.gen_oasis)
-        ET.SubElement(main_node, 'run_length').text = self.run_length
-        ET.SubElement(main_node, 'cos_exe').text = self.cos_exe
+        # The configuration layout is fixed, so directly fill in a template
+        # rather than building and indenting an element tree
+        def _text(value):
+            return '' if value is None else escape(str(value))
+
+        main_opts = [('name', None, self.name),
+                     ('install_dir', None, self.install_dir),
+                     ('cosmo_only', 'py_eval', self.cosmo_only),
+                     ('gen_oasis', 'py_eval', self.gen_oasis),
+                     ('run_length', None, self.run_length),
+                     ('cos_exe', None, self.cos_exe)]
         if not self.cosmo_only:
-            ET.SubElement(main_node, 'cesm_exe').text = self.cesm_exe
-        ET.SubElement(main_node, 'cos_in').text = self.cos_in
-        ET.SubElement(main_node, 'archive_dir').text = self.archive_dir
-        ET.SubElement(main_node, 'gpu_mode', type='py_eval').text = str(self.gpu_mode)
-        ET.SubElement(main_node, 'dummy_day', type='py_eval').text = str(self.dummy_day)
-        ET.SubElement(main_node, 'transfer_all', type='py_eval').text = str(self.transfer_all)
-        ET.SubElement(main_node, 'start_mode').text = self.start_mode
-        node = ET.SubElement(main_node, 'restart_date')
-        if self.start_mode != 'startup':
-            node.text = self.restart_date.strftime(date_fmt['in'])
+            main_opts.append(('cesm_exe', None, self.cesm_exe))
+        main_opts += [('cos_in', None, self.cos_in),
+                      ('archive_dir', None, self.archive_dir),
+                      ('gpu_mode', 'py_eval', self.gpu_mode),
+                      ('dummy_day', 'py_eval', self.dummy_day),
+                      ('transfer_all', 'py_eval', self.transfer_all),
+                      ('start_mode', None, self.start_mode),
+                      ('restart_date', None,
+                       date_to_str(self.restart_date, 'in') if self.start_mode != 'startup' else None)]
+
+        lines = ['<?xml version="1.0" encoding="utf-8"?>',
+                 '<config>',
+                 '  <machine>{:s}</machine>'.format(self._target_machine),
+                 '  <main>']
+        for tag, opt_type, value in main_opts:
+            type_attr = '' if opt_type is None else ' type="{:s}"'.format(opt_type)
+            lines.append('    <{0:s}{1:s}>{2:s}</{0:s}>'.format(tag, type_attr, _text(value)))
+        lines += ['  </main>',
+                  '  <status>',
+                  '    <run_status />',
+                  '    <transfer_status />',
+                  '    <cos_in_file_size />',
+                  '  </status>',
+                  # - ML - Could be usefull in case machine specific arguments need to be stored one day.
+                  #        This isn't the case as of now
+                  '  <{:s} />'.format(self._target_machine),
+                  '</config>']
+
+        self._write_xml_config('\n'.join(lines) + '\n')
 
-        status_node = ET.SubElement(config_node, 'status')
-        ET.SubElement(status_node, 'run_status')
-        ET.SubElement(status_node, 'transfer_status')
-        ET.SubElement(status_node, 'cos_in_file_size')
 
-        # - ML - Could be usefull in case machine specific arguments need to be stored one day.
-        #        This isn't the case as of now
-        ET.SubElement(config_node, self._target_machine)
+    def set_next_run(self):
 
-        indent_xml(config_node)
+        if self._run_end_date < self._end_date:
+            self._update_xml_config({'main/start_mode': 'continue',
+                                     'main/restart_date': date_to_str(self._run_end_date, 'in')})
 
-        tree.write(os.path.join(self.path, self._xml_config), xml_declaration=True)
 
+    def _run_logfile(self, d1, d2):
+        """Log file name of the run job going from d1 to d2"""
 
-    def set_next_run(self):
-
-        if self._run_end_date < self._end_date:
-            tree = ET.parse(os.path.join(self.path, self._xml_config))
-            main_node = tree.find('main')
-            main_node.find('start_mode').text = 'continue'
-            main_node.find('restart_date').text = self._run_end_date.strftime(date_fmt['in'])
-            tree.write(os.path.join(self.path, self._xml_config), xml_declaration=True)
+        return '{:s}_{:s}-{:s}.out'.format(self.name, date_to_str(d1, 'cesm'), date_to_str(d2, 'cesm'))
 
 
     def submit_run(self):
@@ -756,10 +934,13 @@ class cc2_case(object):
     def run(self):
 
         # Monitor time
-        start_time = time.time()
+        start_time = time.perf_counter()
 
-        # Clean workdir
-        file_list = glob('YU*') + glob('debug*') + glob('core*') + glob('nout.*') + glob('*.timers_*')
+        # Clean workdir (YU*, debug*, core*, nout.* and *.timers_* files)
+        with os.scandir('.') as entries:
+            file_list = [e.name for e in entries
+                         if e.name.startswith(('YU', 'debug', 'core', 'nout.'))
+                         or ('.timers_' in e.name and not e.name.startswith('.'))]
         for f in file_list:
             os.remove(f)
 
@@ -770,7 +951,7 @@ class cc2_case(object):
         self._run_fun()
 
         # Monitor time
-        elapsed = time.time() - start_time
+        elapsed = time.perf_counter() - start_time
         print("\nCase {name:s} ran in {elapsed:.2f}\n".format(name=self.name, elapsed=elapsed))
 
 
@@ -821,7 +1002,9 @@ class daint_case(cc2_case):
 
     _target_machine='daint'
     _n_tasks_per_node = 12
-    _default_install_dir = os.path.normpath(os.environ['SCRATCH'])
+    _default_install_dir = os.path.normpath(os.environ['SCRATCH']) if 'SCRATCH' in os.environ else None
+    # Guess from ${PROJECT} environment variable
+    _default_account = os.path.normpath(os.environ['PROJECT']).split(os.path.sep)[-2] if 'PROJECT' in os.environ else None
     _archive_rst_job = 'cc2_archive_rst_job'
 
 
@@ -850,93 +1033,93 @@ class daint_case(cc2_case):
     @account.setter
     def account(self, acc):
         if acc is None:
-            # Guess from ${PROJECT} environment variable
-            self._account = os.path.normpath(os.environ['PROJECT']).split(os.path.sep)[-2]
+            if self._default_account is None:
+                raise ValueError("account has to be given if $PROJECT is not set")
+            self._account = self._default_account
         else:
             self._account = acc
 
+    @cc2_case.install_dir.setter
+    def install_dir(self, ins_dir):
+        if ins_dir is None and self._default_install_dir is None:
+            raise ValueError("install_dir has to be given if $SCRATCH is not set")
+        cc2_case.install_dir.fset(self, ins_dir)
+
 
     def update_xml_config(self):
         tree = ET.parse(os.path.join(self.path, self._xml_config))
         daint_node = tree.find('daint')
         ET.SubElement(daint_node, 'archive_per_month', type='py_eval').text = str(self.archive_per_month)
         indent_xml(tree.getroot())
-        tree.write(os.path.join(self.path, self._xml_config), xml_declaration=True)
+        self._write_xml_config(tree)
 
 
     def _build_run_job(self):
 
         # Header
         # ------
-        script_str = '{:s}\n\n'.format(self.shebang)
-        script_str += '#SBATCH --constraint=gpu\n'
-        script_str += '#SBATCH --job-name={:s}\n'.format(self.name)
-        script_str += '#SBATCH --nodes={:d}\n'.format(self._n_nodes)
-        script_str += '#SBATCH --account={:s}\n'.format(self.account)
-        script_str += '#SBATCH --time={:s}\n'.format(self.run_time)
-        script_str += '#SBATCH --gres=gpu:1\n'
+        lines = [self.shebang, '',
+                 '#SBATCH --constraint=gpu',
+                 '#SBATCH --job-name={:s}'.format(self.name),
+                 '#SBATCH --nodes={:d}'.format(self._n_nodes),
+                 '#SBATCH --account={:s}'.format(self.account),
+                 '#SBATCH --time={:s}'.format(self.run_time),
+                 '#SBATCH --gres=gpu:1']
         if self.partition is not None:
-            script_str += '#SBATCH --partition={:s}\n'.format(self.partition)
+            lines.append('#SBATCH --partition={:s}'.format(self.partition))
 
         # environment variables
         # ---------------------
-        script_str +='''
-export MALLOC_MMAP_MAX_=0
-export MALLOC_TRIM_THRESHOLD_=536870912
-
-# Set this to avoid segmentation faults
-ulimit -s unlimited
-ulimit -a
-
-export OMP_NUM_THREADS=1
-'''
+        lines += ['',
+                  'export MALLOC_MMAP_MAX_=0',
+                  'export MALLOC_TRIM_THRESHOLD_=536870912',
+                  '',
+                  '# Set this to avoid segmentation faults',
+                  'ulimit -s unlimited',
+                  'ulimit -a',
+                  '',
+                  'export OMP_NUM_THREADS=1']
         if self.gpu_mode:
-            script_str += '''
-# Use for gpu mode
-export MV2_ENABLE_AFFINITY=0
-export MV2_USE_CUDA=1
-export MPICH_G2G_PIPELINE=256
-'''
+            lines += ['',
+                      '# Use for gpu mode',
+                      'export MV2_ENABLE_AFFINITY=0',
+                      'export MV2_USE_CUDA=1',
+                      'export MPICH_G2G_PIPELINE=256']
             if self.cosmo_only:
-                script_str += 'export MPICH_RDMA_ENABLED_CUDA=1\n'
+                lines.append('export MPICH_RDMA_ENABLED_CUDA=1')
 
         # Modules
         # -------
-        script_str += '\n'
+        lines.append('')
         if self.modules_opt != 'none':
             # pgi programing environment
             if self.modules_opt == 'purge':
-                script_str += 'module purge\n'
-                script_str += 'module load PrgEnv-pgi\n'
+                lines += ['module purge', 'module load PrgEnv-pgi']
             elif self.modules_opt == 'switch':
-                script_str += 'module switch PrgEnv-cray PrgEnv-pgi\n'
+                lines.append('module switch PrgEnv-cray PrgEnv-pgi')
             # pgi version
             if self.pgi_version is not None:
-                script_str += 'module unload pgi\n'
-                script_str += 'module load pgi/{:s}\n'.format(self.pgi_version)
+                lines += ['module unload pgi', 'module load pgi/{:s}'.format(self.pgi_version)]
 
             # other modules
-            script_str += 'module load daint-gpu\n'
-            script_str += 'module load cray-netcdf\n'
+            lines += ['module load daint-gpu', 'module load cray-netcdf']
             if self.gpu_mode:
-                script_str += 'module load craype-accel-nvidia60\n'
-            script_str += '\n'
+                lines.append('module load craype-accel-nvidia60')
+            lines.append('')
 
         # launch case
         # -----------
-        script_str += 'cc2_control_case ./{:s}'.format(self._xml_config)
+        lines.append('cc2_control_case ./{:s}'.format(self._xml_config))
 
         # Write to file
         # -------------
         with open(os.path.join(self.path, self._run_job), mode='w') as script:
-            script.write(script_str)
+            script.write('\n'.join(lines) + '\n')
 
 
     def _submit_run_cmd(self, d1, d2):
 
-        d1_str = d1.strftime(date_fmt['cesm'])
-        d2_str = d2.strftime(date_fmt['cesm'])
-        logfile = '{:s}_{:s}-{:s}.out'.format(self.name, d1_str, d2_str)
+        logfile = self._run_logfile(d1, d2)
 
         cmd_tmpl = 'sbatch --output={log:s} --error={log:s} {job:s}'
         cmd = cmd_tmpl.format(log=logfile, job=self._run_job)
@@ -948,28 +1131,28 @@ export MPICH_G2G_PIPELINE=256
 
         # Header
         # ------
-        script_str = '#!/bin/bash -l\n\n'
-        script_str += '#SBATCH --partition=xfer\n'
-        script_str += '#SBATCH --ntasks=1\n'
-        script_str += '#SBATCH --time={:s}\n'.format(self.transfer_time)
-        script_str += '#SBATCH --job-name=cc2_transfer\n\n'
+        lines = ['#!/bin/bash -l', '',
+                 '#SBATCH --partition=xfer',
+                 '#SBATCH --ntasks=1',
+                 '#SBATCH --time={:s}'.format(self.transfer_time),
+                 '#SBATCH --job-name=cc2_transfer', '']
 
         # Case dependent variables
         # ------------------------
-        script_str += '# Case dependent variables\n'
-        script_str += '# ------------------------\n'
-        script_str += 'run_job={:s}\n'.format(self._run_job)
-        script_str += 'case_name={:s}\n'.format(self.name)
-        script_str += 'xml_config={:s}\n'.format(self._xml_config)
-        script_str += 'cos_in_origin={:s}\n'.format(self.cos_in)
-        script_str += 'cos_in_target={:s}\n'.format(os.path.join(self.path,'COSMO_input'))
-        script_str += 'transfer_list={:s}\n'.format(self._transfer_list)
+        lines += ['# Case dependent variables',
+                  '# ------------------------',
+                  'run_job={:s}'.format(self._run_job),
+                  'case_name={:s}'.format(self.name),
+                  'xml_config={:s}'.format(self._xml_config),
+                  'cos_in_origin={:s}'.format(self.cos_in),
+                  'cos_in_target={:s}'.format(os.path.join(self.path,'COSMO_input')),
+                  'transfer_list={:s}'.format(self._transfer_list)]
 
         # Main script
         # -----------
         # Use sed commands to handle case status as python isn't available on the xfer queue.
         # Otherwise just use cc2_control --action=transfer
-        script_str += '''
+        lines.append('''
 # Functions to get and set case status
 # ------------------------------------
 get_status(){
@@ -985,7 +1168,7 @@ set_status "transfer" "transferring"
 
 # Transfer
 # --------
-rsync -avrL --files-from ${transfer_list} ${cos_in_origin} ${cos_in_target}
+rsync -aLW --inplace --info=progress2,stats2 --files-from ${transfer_list} ${cos_in_origin} ${cos_in_target}
 
 # Submit next run
 # ---------------
@@ -1000,18 +1183,18 @@ fi
 
 # Set transfer status
 # -------------------
-set_status "transfer" "complete"'''
+set_status "transfer" "complete"''')
 
         # Write to file
         # -------------
         with open(os.path.join(self.path, self._transfer_job), mode='w') as script:
-            script.write(script_str)
+            script.write('\n'.join(lines) + '\n')
 
 
     def _submit_transfer_cmd(self, d1, d2):
 
-        d1_str = d1.strftime(date_fmt['cesm'])
-        d2_str = d2.strftime(date_fmt['cesm'])
+        d1_str = date_to_str(d1, 'cesm')
+        d2_str = date_to_str(d2, 'cesm')
         logfile = 'transfer_{:s}-{:s}.out'.format(d1_str, d2_str)
 
         # - ML - adding d1 and d2 as positionnal arguments in case a
@@ -1029,37 +1212,37 @@ set_status "transfer" "complete"'''
 
         # Header
         # ------
-        script_str = '#!/bin/bash -l\n\n'
-        script_str += '#SBATCH --partition=xfer\n'
-        script_str += '#SBATCH --ntasks=1\n'
-        script_str += '#SBATCH --time={:s}\n'.format(self.archive_time)
-        script_str += '#SBATCH --account={:s}\n'.format(self.account)
-        script_str += '#SBATCH --job-name=cc2_archive\n\n'
+        lines = ['#!/bin/bash -l', '',
+                 '#SBATCH --partition=xfer',
+                 '#SBATCH --ntasks=1',
+                 '#SBATCH --time={:s}'.format(self.archive_time),
+                 '#SBATCH --account={:s}'.format(self.account),
+                 '#SBATCH --job-name=cc2_archive', '']
 
         # Case dependent variables
         # ------------------------
-        script_str += '# Case dependent variables\n'
-        script_str += '# ------------------------\n'
-        script_str += 'CASE_NAME={:s}\n'.format(self.name)
-        script_str += 'archive_dir={:s}\n'.format(os.path.join(self.archive_dir, self.name))
-        script_str += 'archive_cesm={:s}\n'.format('true' if self.archive_cesm else 'false')
+        lines += ['# Case dependent variables',
+                  '# ------------------------',
+                  'CASE_NAME={:s}'.format(self.name),
+                  'archive_dir={:s}'.format(os.path.join(self.archive_dir, self.name)),
+                  'archive_cesm={:s}'.format('true' if self.archive_cesm else 'false')]
         # COSMO output streams
         stream_list = ['"{:s}"'.format(os.path.normpath(gribout['ydir'])) for gribout in self._get_gribouts()]
-        script_str += 'COSMO_gribouts=({:s})\n'.format(' '.join(stream_list))
+        lines.append('COSMO_gribouts=({:s})'.format(' '.join(stream_list)))
         # CESM output streams
         if not self.cosmo_only:
             stream_list = ['"h0"']
             for k in range(2,7):
                if 'hist_fincl{:d}'.format(k) in self.nml['lnd_in']['clm_inparm']:
                    stream_list += ['"h{:d}"'.format(k-1)]
-            script_str += 'CESM_hh=({:s})\n'.format(' '.join(stream_list))
+            lines.append('CESM_hh=({:s})'.format(' '.join(stream_list)))
         # Archiving options
-        script_str += 'remove_originals={:s}\n'.format('true' if self.archive_rm else 'false')
-        script_str += 'compression={:s}\n'.format(self.archive_compression)
+        lines += ['remove_originals={:s}'.format('true' if self.archive_rm else 'false'),
+                  'compression={:s}'.format(self.archive_compression)]
 
         # Main script
         # -----------
-        script_str += '''
+        lines.append('''
 # Extract date components
 # -----------------------
 YS="${1:0:4}"
@@ -1133,42 +1316,42 @@ for ((YYYY=YS; YYYY<=YE; YYYY++)); do
             done
         fi
     done
-done'''
+done''')
 
         # Write to file
         # -------------
         with open(os.path.join(self.path, self._archive_job), mode='w') as script:
-            script.write(script_str)
+            script.write('\n'.join(lines) + '\n')
 
         # Build archive job for restart files
         # ===================================
 
         # Header
         # ------
-        script_str = '#!/bin/bash -l\n\n'
-        script_str += '#SBATCH --partition=xfer\n'
-        script_str += '#SBATCH --ntasks=1\n'
-        script_str += '#SBATCH --time={:s}\n'.format(self.archive_time)
-        script_str += '#SBATCH --account={:s}\n'.format(self.account)
-        script_str += '#SBATCH --job-name=cc2_archive_rst\n\n'
+        lines = ['#!/bin/bash -l', '',
+                 '#SBATCH --partition=xfer',
+                 '#SBATCH --ntasks=1',
+                 '#SBATCH --time={:s}'.format(self.archive_time),
+                 '#SBATCH --account={:s}'.format(self.account),
+                 '#SBATCH --job-name=cc2_archive_rst', '']
 
         # Case dependent variables
         # ------------------------
-        script_str += '# Case dependent variables\n'
-        script_str += 'CASE_NAME={:s}\n'.format(self.name)
-        script_str += 'archive_dir={:s}\n'.format(os.path.join(self.archive_dir, self.name))
+        lines += ['# Case dependent variables',
+                  'CASE_NAME={:s}'.format(self.name),
+                  'archive_dir={:s}'.format(os.path.join(self.archive_dir, self.name))]
         if 'ydir_restart' in self.nml['INPUT_IO']['ioctl']:
             COSMO_restart_dir = self.nml['INPUT_IO']['ioctl']['ydir_restart']
         elif 'ydir_restart_in' in self.nml['INPUT_IO']['ioctl']:
             COSMO_restart_dir = self.nml['INPUT_IO']['ioctl']['ydir_restart_in']
         else:
             COSMO_restart_dir = '.'
-        script_str += 'COSMO_restart_dir={:s}\n\n'.format(COSMO_restart_dir)
-        script_str += 'compression={:s}\n'.format(self.archive_compression)
+        lines += ['COSMO_restart_dir={:s}'.format(COSMO_restart_dir), '',
+                  'compression={:s}'.format(self.archive_compression)]
 
         # Main script
         # -----------
-        script_str += '''
+        lines.append('''
 # Extract date components
 # -----------------------
 YYYY="${1:0:4}"
@@ -1250,12 +1433,12 @@ fi
 target_dir=${archive_dir}/CESM_output/restart
 mkdir -p ${target_dir}
 echo "    transferring ${transfer_name} to ${target_dir}"
-rsync -ar ${transfer_name} ${target_dir} --remove-source-files'''
+rsync -ar ${transfer_name} ${target_dir} --remove-source-files''')
 
         # Write to file
         # -------------
         with open(os.path.join(self.path, self._archive_rst_job), mode='w') as script:
-            script.write(script_str)
+            script.write('\n'.join(lines) + '\n')
 
 
     def _submit_archive_cmd(self):
@@ -1263,7 +1446,7 @@ rsync -ar ${transfer_name} ${target_dir} --remove-source-files'''
         # Submit output archive job(s)
         # ============================
         def _assemble_cmd_and_submit(d1, d2):
-            d1_str, d2_str = d1.strftime('%Y%m'), d2.strftime('%Y%m')
+            d1_str, d2_str = date_to_str(d1, 'month'), date_to_str(d2, 'month')
             cmd_tmpl = 'sbatch --output={log:s} --error={log:s} {job:s} {d1:s} {d2:s}'
             logfile = '{:s}_{:s}-{:s}.out'.format('archive', d1_str, d2_str)
             cmd = cmd_tmpl.format(job=self._archive_job, d1=d1_str, d2=d2_str, log=logfile)
@@ -1283,8 +1466,7 @@ rsync -ar ${transfer_name} ${target_dir} --remove-source-files'''
             cur_start_date = start_archive_date
             while cur_start_date < end_archive_date:
                 cur_month_beg = datetime(cur_start_date.year, cur_start_date.month, 1)
-                tmp_date = add_time_from_str(cur_start_date, '1m')
-                cur_month_end = datetime(tmp_date.year, tmp_date.month, 1)
+                cur_month_end = add_time_from_str(cur_month_beg, '1m')
                 # Check that the we have to proceed to archiving for that period
                 if cur_month_end <= end_archive_date or end_archive_date >= self.end_date:
                     # Determine date for archive job and submit
@@ -1302,8 +1484,7 @@ rsync -ar ${transfer_name} ${target_dir} --remove-source-files'''
                     d2 = add_time_from_str(end_archive_date, '-1m')
                 proceed = True
             else:
-                tmp_date = add_time_from_str(start_archive_date, '1m')
-                first_month_end = datetime(tmp_date.year, tmp_date.month, 1)
+                first_month_end = add_time_from_str(datetime(start_archive_date.year, start_archive_date.month, 1), '1m')
                 if end_archive_date >= first_month_end:
                     d1 = datetime(start_archive_date.year, start_archive_date.month, 1)
                     tmp_date = add_time_from_str(end_archive_date, '-1m')
@@ -1316,7 +1497,7 @@ rsync -ar ${transfer_name} ${target_dir} --remove-source-files'''
         # Submit restart archive job
         # ==========================
         end_date = min(self._run_end_date, self.end_date)
-        end_date_str = end_date.strftime(date_fmt['cosmo'])
+        end_date_str = date_to_str(end_date, 'cosmo')
         logfile = '{:s}_{:s}.out'.format('archive_restart', end_date_str)
         cmd_tmpl = 'sbatch --output={log:s} --error={log:s} {job:s} {d:s}'
         cmd = cmd_tmpl.format(job=self._archive_rst_job, d=end_date_str, log=logfile)
@@ -1344,32 +1525,26 @@ rsync -ar ${transfer_name} ${target_dir} --remove-source-files'''
     def _build_proc_config(self):
 
         # Build executable bash files
-        f_path = os.path.join(self.path, 'cosmo.bash')
-        with open(f_path, 'w') as f:
-            f.write("#!/bin/bash\n")
-            if self.gpu_mode: 
-                f.write("export MPICH_RDMA_ENABLED_CUDA=1\n")
-            f.write("./{:s}".format(self.cos_exe))
-        os.chmod(f_path, 0o755)
-        f_path = os.path.join(self.path, 'cesm.bash')
-        with open(f_path, 'w') as f:
-            f.write("#!/bin/bash\n")
+        for name, exe, rdma in [('cosmo', self.cos_exe, 1), ('cesm', self.cesm_exe, 0)]:
+            lines = ['#!/bin/bash']
             if self.gpu_mode:
-                f.write("export MPICH_RDMA_ENABLED_CUDA=0\n")
-            f.write("./{:s}".format(self.cesm_exe))
-        os.chmod(f_path, 0o755)
+                lines.append('export MPICH_RDMA_ENABLED_CUDA={:d}'.format(rdma))
+            lines.append('./{:s}'.format(exe))
+            f_path = os.path.join(self.path, '{:s}.bash'.format(name))
+            with open(f_path, 'w') as f:
+                f.write('\n'.join(lines))
+            os.chmod(f_path, 0o755)
 
         # Build proc_config
+        if self.gpu_mode:
+            N = self._n_tasks_per_node
+            cos_tasks = ",".join([str(k*N) for k in range(self._n_nodes)])
+            cesm_tasks = ",".join(["{:d}-{:d}".format(k*N+1,(k+1)*N-1) for k in range(self._n_nodes)])
+        else:
+            cos_tasks = '{:d}-{:d}'.format(0, self._ncos-1)
+            cesm_tasks = '{:d}-{:d}'.format(self._ncos, self._ncos+self._ncesm-1)
         with open(os.path.join(self.path, 'proc_config'), mode='w') as f:
-            if self.gpu_mode:
-                N = self._n_tasks_per_node
-                tasks = ",".join([str(k*N) for k in range(self._n_nodes)])
-                f.write("{:s} ./cosmo.bash\n".format(tasks))
-                tasks = ",".join(["{:d}-{:d}".format(k*N+1,(k+1)*N-1) for k in range(self._n_nodes)])
-                f.write("{:s} ./cesm.bash".format(tasks))
-            else:
-                f.write('{:d}-{:d} ./cosmo.bash\n'.format(0, self._ncos-1))
-                f.write('{:d}-{:d} ./cesm.bash'.format(self._ncos, self._ncos+self._ncesm-1))
+            f.write("{:s} ./cosmo.bash\n{:s} ./cesm.bash".format(cos_tasks, cesm_tasks))
 
 @available
 class mistral_case(cc2_case):
@@ -1392,44 +1567,46 @@ class mistral_case(cc2_case):
 
     def _build_proc_config(self):
 
+        lines = ['{:d}-{:d} ./{:s}'.format(0, self._ncos-1, self.cos_exe)]
+        if not self.cosmo_only:
+            lines.append('{:d}-{:d} ./{:s}'.format(self._ncos, self._ncos+self._ncesm-1, self.cesm_exe))
         with open(os.path.join(self.path, 'proc_config'), mode='w') as f:
-            f.write('{:d}-{:d} ./{:s}\n'.format(0, self._ncos-1, self.COSMO_exe))
-            if not self.cosmo_only:
-                f.write('{:d}-{:d} ./{:s}\n'.format(self._ncos, self._ncos+self._ncesm-1, self.CESM_exe))
+            f.write('\n'.join(lines) + '\n')
 
 
     def _build_run_job(self):
 
         # shebang
-        script_str = '#!/usr/bin/env bash\n\n'
+        lines = ['#!/usr/bin/env bash', '']
 
         # slurm options
-        scripte_str +='#SBATCH --job-name={:s}\n'.format(self.name)
-        scripte_str +='#SBATCH --nodes={:d}\n'.format(self._n_nodes)
-        scripte_str +='#SBATCH --account={:s}\n'.format(self.account)
-        scripte_str +='#SBATCH --time={:s}\n'.format(self.run_time)
+        lines += ['#SBATCH --job-name={:s}'.format(self.name),
+                  '#SBATCH --nodes={:d}'.format(self._n_nodes),
+                  '#SBATCH --account={:s}'.format(self.account),
+                  '#SBATCH --time={:s}'.format(self.run_time)]
         if self.partition is not None:
-            scripte_str += '#SBATCH --partition={:s}\n'.format(self.partition)
+            lines.append('#SBATCH --partition={:s}'.format(self.partition))
 
         # environment variables
-        scripte_str += 'export LD_LIBRARY_PATH=/sw/rhel6-x64/netcdf/netcdf_fortran-4.4.3-parallel-openmpi2-intel14/lib/:/sw/rhel6-x64/netcdf/parallel_netcdf-1.6.1-openmpi2-intel14/lib\n\n'
-        script_str += '# Set this to avoid segmentation faults\n'
-        script_str += 'ulimit -s unlimited\n'
-        script_str += 'ulimit -a\n\n'
-        script_str += 'export OMP_NUM_THREADS=1\n\n'
+        lines += ['export LD_LIBRARY_PATH=/sw/rhel6-x64/netcdf/netcdf_fortran-4.4.3-parallel-openmpi2-intel14/lib/:/sw/rhel6-x64/netcdf/parallel_netcdf-1.6.1-openmpi2-intel14/lib',
+                  '',
+                  '# Set this to avoid segmentation faults',
+                  'ulimit -s unlimited',
+                  'ulimit -a',
+                  '',
+                  'export OMP_NUM_THREADS=1',
+                  '']
 
         # launch case
-        scripte_str += 'cc2_control_case ./{:s}\n'.format(self._xml_config)
+        lines.append('cc2_control_case ./{:s}'.format(self._xml_config))
 
         with open(os.path.join(self.path, self._run_job), mode='w') as script:
-            script.write(script_str)
+            script.write('\n'.join(lines) + '\n')
 
 
     def _submit_run_cmd(self, d1, d2):
 
-        d1_str = d1.strftime(date_fmt['cesm'])
-        d2_str = d2.strftime(date_fmt['cesm'])
-        logfile = '{:s}_{:s}-{:s}.out'.format(self.name, d1_str, d2_str)
+        logfile = self._run_logfile(d1, d2)
 
         cmd_tmpl = 'sbatch --output={log:s} --error={log:s} {job:s}'
         cmd = cmd_tmpl.format(log=logfile, job=self._run_job)
@@ -1439,7 +1616,7 @@ class mistral_case(cc2_case):
 
     def _run_fun(self):
         if self.cosmo_only:
-            run_cmd = 'srun -u -n {:d} {:s}'.format(self._n_nodes * self._n_tasks_per_node, self.COSMO_exe)
+            run_cmd = 'srun -u -n {:d} {:s}'.format(self._n_nodes * self._n_tasks_per_node, self.cos_exe)
         else:
             self._build_proc_config()
             run_cmd = 'srun -u --multi-prog ./proc_config'
@@ -1448,19 +1625,62 @@ class mistral_case(cc2_case):
         check_call(run_cmd, shell=True)
 
 class nmldict(dict):
-    """Dictionnary of all the namelists of a case. Only load the namelist if needed"""
+    """Dictionnary of all the namelists of a case. Only load the namelist if needed
+    and only write it back to file if it has been modified"""
     def __init__(self, cc2case):
         dict.__init__(self)
         self.cc2case = cc2case
 
     def __getitem__(self, key):
         if key not in self:
-            self[key] = f90nml.read(os.path.join(self.cc2case.path, key))
+            self[key] = _read_nml(self._file_path(key))
         return dict.__getitem__(self, key)
 
+    def _file_path(self, name):
+        return os.path.abspath(os.path.join(self.cc2case.path, name))
+
+    def is_modified(self, name):
+        """Compare namelist to its last version read from or written to file"""
+        cached = _nml_cache.get(self._file_path(name))
+        return cached is None or self[name] != cached[1]
+
+    def prefetch(self, names):
+        """Read several namelists at once, in parallel if there are enough of them"""
+        names = [name for name in names if name not in self]
+        paths = [self._file_path(name) for name in names]
+        to_parse = [path for path in paths if not _nml_cached(path)]
+        if len(to_parse) >= _nml_pool_min_files and 'fork' in multiprocessing.get_all_start_methods():
+            n_proc = min(len(to_parse), multiprocessing.cpu_count(), 8)
+            with multiprocessing.get_context('fork').Pool(n_proc) as pool:
+                results = pool.map(_read_nml_file, to_parse)
+            _nml_cache.update(zip(to_parse, results))
+        for name, path in zip(names, paths):
+            self[name] = _read_nml(path)
+
     def write(self, name):
-        self[name].write(os.path.join(self.cc2case.path, name), force=True)
+        path = self._file_path(name)
+        self[name].write(path, force=True)
+        _nml_cache[path] = (os.stat(path).st_mtime_ns, copy.deepcopy(self[name]))
 
     def write_all(self):
         for name in self:
-            self.write(name)
+            if self.is_modified(name):
+                self.write(name)
+
+
+def _read_nml_file(path):
+    """Parse namelist file and return it with the file modification time"""
+    return os.stat(path).st_mtime_ns, f90nml.read(path)
+
+
+def _nml_cached(path):
+    """Check if the cached version of the namelist file is up to date"""
+    return path in _nml_cache and _nml_cache[path][0] == os.stat(path).st_mtime_ns
+
+
+def _read_nml(path):
+    """Read namelist file, reusing the already parsed version if the file didn't change"""
+    if not _nml_cached(path):
+        _nml_cache[path] = _read_nml_file(path)
+    # Return a copy as namelists are modified in place by cases
+    return copy.deepcopy(_nml_cache[path][1])
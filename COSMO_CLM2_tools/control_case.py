@@ -15,10 +15,10 @@ def control_case():
     cfg = parser.parse_args()
 
     # build cc2case object from xml file
-    config = ET.parse(cfg.xml_path).getroot()
-    machine = config.find('machine').text
-    case_args = get_xml_node_args(config.find('main'))
-    case_args.update(get_xml_node_args(config.find(machine)))
+    config = {node.tag: node for node in ET.parse(cfg.xml_path).getroot()}
+    machine = config['machine'].text
+    case_args = get_xml_node_args(config.get('main'))
+    case_args.update(get_xml_node_args(config.get(machine)))
     cc2case = cc2_case_factory(machine, **case_args)
 
     if cfg.action == 'run':
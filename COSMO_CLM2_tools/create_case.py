@@ -1,49 +1,46 @@
 from __future__ import print_function
 from .cc2_case import factory as cc2_case_factory, available_cases
-from .tools import date_fmt, get_xml_node_args
+from .tools import date_fmt, get_xml_node_args, xml_types, load_setup, str_to_bool
 from subprocess import check_call
-from argparse import ArgumentParser, RawTextHelpFormatter, Action as arg_action
+from argparse import ArgumentParser, RawTextHelpFormatter, Namespace, Action as arg_action
 import f90nml
+import ast
+from itertools import groupby
 from datetime import datetime, timedelta
 import os
-import xml.etree.ElementTree as ET
 import shutil
 
-def create_case():
-    """
-    Create a Cosmo-CLM2 case from cmd line arguments and xml setup file
+# Top level nodes of the xml setup file used to create a case
+_setup_tags = frozenset(('main', 'machine', 'change_par', 'del_par') + tuple(available_cases))
 
-    See ``cc2_create_case --help``
-    """
+def _build_parser():
+    """Build command line parser
 
-    # Build command line parser
-    # =========================
+    Return the parser and the names of the groups in which case arguments are
+    collected, stored as {group: {dest: value}} in the cc2_cmd_args attribute of
+    the namespace passed to parse_args"""
 
     # Custom action factory to fill in cc2_cmd_args dictionnary
-    cc2_cmd_args = {}
+    cc2_groups = []
     case_actions = {}
 
     def cc2_act(*groups):
 
         for group in groups:
-            if group not in cc2_cmd_args:
-                cc2_cmd_args[group] = {}
+            if group not in cc2_groups:
+                cc2_groups.append(group)
 
         key = '.'.join(groups)
 
         if key not in case_actions:
-            def call(self, parser, args, values, option_string=None):
+            def call(self, parser, namespace, values, option_string=None):
                 for group in self.cc2_groups:
-                    cc2_cmd_args[group][self.dest] = values
+                    namespace.cc2_cmd_args[group][self.dest] = values
             name = 'cc2_' + '_'.join(groups)
             case_actions[key] = type(name, (arg_action,),{'__call__': call, 'cc2_groups': groups})
 
         return case_actions[key]
 
-    # function for boolean type
-    def str_to_bool(val_str):
-        return bool(eval(val_str))
-
     # Create parser
     dsc = "Set up and run a COSMO_CLM2 case\n"\
           "--------------------------------\n"\
@@ -116,7 +113,7 @@ def create_case():
                             help="run only cosmo with build-in soil model TERRA\n"
                             "(type: bool, using anything Python can parse as a boolean, default: False)\n"
                             "Be carefull to provide a COSMO executable compiled accordingly")
-    main_group.add_argument('--start_mode', action=cc2_act('main'), type=str_to_bool,
+    main_group.add_argument('--start_mode', action=cc2_act('main'),
                             choices=['startup', 'continue', 'restart'],
                             help="if not startup, use in conjunction with restart_date,\n"
                             "cos_rst and CESM_rst options (default: 'startup')")
@@ -172,11 +169,25 @@ def create_case():
     cmd_line_group.add_argument('--no_submit', action='store_false', dest='submit',
                                 help="do not submit job after setup")
 
-    opts = parser.parse_args()
+    return parser, tuple(cc2_groups)
+
+_parser, _cc2_groups = _build_parser()
+
+
+def create_case():
+    """
+    Create a Cosmo-CLM2 case from cmd line arguments and xml setup file
+
+    See ``cc2_create_case --help``
+    """
+
+    # Parse command line
+    # ==================
+    opts = _parser.parse_args(namespace=Namespace(cc2_cmd_args={g: {} for g in _cc2_groups}))
 
     # Parse machine and case argumennts from cmd line args and xml file
     # =================================================================
-    machine, cc2_args = get_case_args(opts, cc2_cmd_args)
+    machine, cc2_args = get_case_args(opts, opts.cc2_cmd_args)
 
     # Create case instance
     # ====================
@@ -196,27 +207,27 @@ def get_case_args(cmd_opts, cc2_cmd_args):
 
     machine = cmd_opts.machine
 
+    main_node = machine_node = None
     xml_file = cmd_opts.setup_file
     if xml_file is not None:
-        tree_root = ET.parse(xml_file).getroot()
-        main_node = tree_root.find('main')
+        nodes = {node.tag: node for node in load_setup(xml_file, _setup_tags)}
+        main_node = nodes.get('main')
         if machine is None:
-            machine_name_node = tree_root.find('machine')
+            machine_name_node = nodes.get('machine')
             if machine_name_node is not None:
                 machine = machine_name_node.text
-        machine_node = tree_root.find(machine)
+        machine_node = nodes.get(machine)
 
     if machine is None:
         raise ValueError("'machine' option has to be given either by the command line or the xml setup file")
 
-    main_args = get_xml_node_args(main_node) if xml_file is not None else {}
-    main_args.update(cc2_cmd_args['main'])
-
-    machine_args = get_xml_node_args(machine_node) if xml_file is not None else {}
-    machine_args.update(cc2_cmd_args[machine])
-
-    cc2_args = {k:v for k,v in main_args.items() if v is not None}
-    cc2_args.update({k:v for k,v in machine_args.items() if v is not None})
+    # xml options first, overridden by command line ones, machine specific last
+    cc2_args = {}
+    for node, cmd_args in ((main_node, cc2_cmd_args['main']),
+                           (machine_node, cc2_cmd_args.get(machine, {}))):
+        args = get_xml_node_args(node) if node is not None else {}
+        args.update(cmd_args)
+        cc2_args.update((k, v) for k, v in args.items() if v is not None)
 
     return machine, cc2_args
 
@@ -226,58 +237,66 @@ def modify_nml_from_xml(cc2case, cmd_opts):
     if cmd_opts.setup_file is None:
         return
 
-    tree_root = ET.parse(cmd_opts.setup_file).getroot()
-
-    # Change parameters
-    nodes = tree_root.findall('change_par')
-    if nodes:
-        for node in nodes:
-            name = node.get('file')
-            block = node.get('block')
-            n = node.get('n')
-            param = node.get('param')
-            val_str = node.text
-            if name is None:
-                raise ValueError("'file' xml attribute is required to change parameter")
-            if block is None:
-                raise ValueError("'block' xml attribute is required to change parameter")
-            if param is None:
-                raise ValueError("'param' xml attribute is required to change parameter")
-            if node.get('type') is None:
-                value = val_str
-            elif node.get('type') == 'py_eval':
-                value = eval(val_str)
-            else:
-                val_type = eval(node.get('type'))
-                if isinstance(val_type, type):
-                    value = val_type(val_str)
-                else:
-                    err_mess = "Given xml atribute 'type' for parameter {:s} is {:s}\n"\
-                               "It has to be either 'py_eval' or a valid build in python type"
-                    raise ValueError(err_mess.format(param, val_type))
-            if n is None:
-                cc2case.nml[name][block][param] = value
-            else:
-                cc2case.nml[name][block][int(n)-1][param] = value
-
-    # Delete parameters
-    nodes = tree_root.findall('del_par')
-    if nodes:
-        for node in nodes:
-            name = node.get('file')
-            block = node.get('block')
-            n = node.get('n')
-            param = node.get('param')
-            if name is None:
-                raise ValueError("'file' xml attribute is required to delete parameter")
-            if block is None:
-                raise ValueError("'block' xml attribute is required to delete parameter")
-            if param is None:
-                raise ValueError("'param' xml attribute is required to delete parameter")
-            if n is None:
-                del cc2case.nml[name][block][param]
-            else:
-                del cc2case.nml[name][block][int(n)-1][param]
-
-    # Write namelists to file
+    tree_root = load_setup(cmd_opts.setup_file, _setup_tags)
+
+    # Collect and check change_par and del_par nodes
+    handlers = {'change_par': _change_nml_par, 'del_par': _del_nml_par}
+    nodes = [node for node in tree_root if node.tag in handlers]
+    for node in nodes:
+        _check_nml_par_attrs(node, 'change' if node.tag == 'change_par' else 'delete')
+
+    # Apply them block by block. Within a block, changes come before deletions
+    # and the stable sort keeps the file order otherwise
+    nodes.sort(key=lambda node: _nml_par_block(node) + (node.tag == 'del_par',))
+    for (name, block), block_nodes in groupby(nodes, key=_nml_par_block):
+        nml_block = cc2case.nml[name][block]
+        for node in block_nodes:
+            handlers[node.tag](nml_block, node)
+
+    # Write all modified namelists to file at once
     cc2case.write_open_nml()
+
+# xml attributes required by change_par and del_par nodes
+_nml_par_attrs = frozenset(('file', 'block', 'param'))
+
+def _check_nml_par_attrs(node, action):
+    """Raise a ValueError listing the required attributes missing from a change_par/del_par node"""
+
+    missing = _nml_par_attrs - node.attrib.keys()
+    if missing:
+        raise ValueError("xml attribute(s) " + ', '.join("'{:s}'".format(a) for a in sorted(missing))
+                         + " required to " + action + " parameter")
+
+def _nml_par_block(node):
+    return node.get('file'), node.get('block')
+
+def _change_nml_par(nml_block, node):
+    """Change parameter of namelist block following a change_par xml node"""
+
+    n, param, val_str = node.get('n'), node.get('param'), node.text
+    type_attr = node.get('type')
+    if type_attr is None:
+        value = val_str
+    elif type_attr == 'py_eval':
+        value = ast.literal_eval(val_str)
+    else:
+        val_type = xml_types.get(type_attr)
+        if val_type is not None:
+            value = val_type(val_str)
+        else:
+            err_mess = "Given xml atribute 'type' for parameter {:s} is {:s}\n"\
+                       "It has to be either 'py_eval' or one of {:s}"
+            raise ValueError(err_mess.format(param, type_attr, ', '.join(xml_types)))
+    if n is None:
+        nml_block[param] = value
+    else:
+        nml_block[int(n)-1][param] = value
+
+def _del_nml_par(nml_block, node):
+    """Delete parameter of namelist block following a del_par xml node"""
+
+    n, param = node.get('n'), node.get('param')
+    if n is None:
+        del nml_block[param]
+    else:
+        del nml_block[int(n)-1][param]
@@ -1,50 +1,89 @@
 from datetime import datetime, timedelta
-date_fmt = {'in': '%Y-%m-%d-%H', 'cosmo': '%Y%m%d%H','cesm': '%Y%m%d'}
+import ast
+import calendar
+from functools import lru_cache
+import os
+import re
+import xml.etree.ElementTree as ET
+date_fmt = {'in': '%Y-%m-%d-%H', 'cosmo': '%Y%m%d%H','cesm': '%Y%m%d', 'month': '%Y%m'}
+# Equivalent format templates, much faster than strftime
+_date_tmpl = {'in': '{:04d}-{:02d}-{:02d}-{:02d}', 'cosmo': '{:04d}{:02d}{:02d}{:02d}', 'cesm': '{:04d}{:02d}{:02d}',
+              'month': '{:04d}{:02d}'}
+
+def date_to_str(date, fmt):
+    """Return date.strftime(date_fmt[fmt]) using direct attribute access"""
+    return _date_tmpl[fmt].format(date.year, date.month, date.day, date.hour)
+
+
+def date_to_ymd(date):
+    """Return date as the yyyymmdd integer used in CESM namelists"""
+    return date.year * 10000 + date.month * 100 + date.day
+
+
+def ymd_to_date(ymd):
+    """Return datetime from a yyyymmdd integer as used in CESM namelists"""
+    ym, d = divmod(int(ymd), 100)
+    y, m = divmod(ym, 100)
+    return datetime(y, m, d)
+
 
 def COSMO_input_file_name(root, date, ext):
-    return root + date.strftime(date_fmt['cosmo']) + ext
+    return root + date_to_str(date, 'cosmo') + ext
 
 
+# Date increment strings: 'N1yN2m', 'N1y', 'N2m', 'N3d' or 'N4h'
+_dt_str_re = re.compile(r'(?:(?:([+-]?\d+)y)?(?:([+-]?\d+)m)?|([+-]?\d+)d|([+-]?\d+)h)')
+
+# Within a process, only the archive loops of _submit_archive_cmd call this
+# repeatedly with the same arguments (month starts and fixed increments)
+@lru_cache(maxsize=128)
 def add_time_from_str(date1, dt_str):
     """Increment date from a string
 
     Return the date resulting from date + N1 years + N2 months or date + N3 days
-    where dt_str is a string of the form 'N1yN2m' or 'N1y' or 'N2m' or 'N3d',
-    N1, N2 and N3 being arbitrary integers potentially including sign and
-    'y', 'm' and 'd' the actual letters standing for year, month and day respectivly."""
-
-    ny, nm, nd, nh = None, None, None, None
-    ks = 0
-    for ke, c in enumerate(dt_str):
-        if c == 'y':
-            ny = int(dt_str[ks:ke])
-            ks = ke+1
-        elif c == 'm':
-            nm = int(dt_str[ks:ke])
-            ks = ke+1
-        elif c == 'd':
-            nd = int(dt_str[ks:ke])
-            ks = ke+1
-        elif c == 'h':
-            nh = int(dt_str[ks:ke])
-            ks = ke+1
+    or date + N4 hours where dt_str is a string of the form 'N1yN2m' or 'N1y' or 'N2m'
+    or 'N3d' or 'N4h', N1, N2, N3 and N4 being arbitrary integers potentially including
+    sign and 'y', 'm', 'd' and 'h' the actual letters standing for year, month, day
+    and hour respectivly."""
+
+    match = _dt_str_re.fullmatch(dt_str)
+    if match is None or not dt_str:
+        raise ValueError("date increment '" + dt_str + "' doesn't have the correct format")
+    ny, nm, nd, nh = (None if g is None else int(g) for g in match.groups())
 
     # Compute new date
-    if ny is not None or nm is not None:
-        y2, m2, d2, h2 = date1.year, date1.month, date1.day, date1.hour
+    if nd is not None:
+        return date1 + timedelta(days=nd)
+    elif nh is not None:
+        return date1 + timedelta(hours=nh)
+    else:
+        y2, m2 = date1.year, date1.month
         if ny is not None:
             y2 += ny
         if nm is not None:
             y2 += (nm+m2-1) // 12
             m2 = (nm+m2-1) % 12 + 1
-        return datetime(y2, m2, d2, h2)
-    elif nd is not None:
-        return date1 + timedelta(days=nd)
-    elif nh is not None:
-        return date1 + timedelta(hours=nh)
-    else:
-        raise ValueError("date increment '" + dt_str + "' doesn't have the correct format")
+        # Clamp day to the end of the month (e.g. Jan 31 + 1m gives Feb 28/29)
+        return date1.replace(year=y2, month=m2, day=min(date1.day, calendar.monthrange(y2, m2)[1]))
+
+
+_bool_map = {'true': True, 'yes': True, '1': True, 'false': False, 'no': False, '0': False}
 
+def str_to_bool(val_str):
+    """Interpret a string as a boolean (true/false, yes/no or 1/0, case insensitive, or any Python literal)"""
+
+    value = _bool_map.get(val_str.strip().lower())
+    if value is None:
+        try:
+            value = bool(ast.literal_eval(val_str))
+        except (ValueError, SyntaxError):
+            raise ValueError("cannot interpret '" + val_str + "' as a boolean")
+    return value
+
+
+# Python types accepted in the 'type' attribute of xml nodes, 'bool' parsing the string
+xml_types = {t.__name__: t for t in (str, int, float, complex)}
+xml_types['bool'] = str_to_bool
 
 def get_xml_node_args(node, exclude=()):
     """Read case arguments from xml node"""
@@ -56,25 +95,61 @@ def get_xml_node_args(node, exclude=()):
 
     for opt in node.iter():
         if opt is not node and opt.tag not in exclude:
+            type_attr = opt.get('type')
             if opt.text is None:
                 xml_args[opt.tag] = None
-            elif opt.get('type') is None:
+            elif type_attr is None:
                 xml_args[opt.tag] = opt.text
-            elif opt.get('type') == 'py_eval':
-                xml_args[opt.tag] = eval(opt.text)
+            elif type_attr == 'py_eval':
+                xml_args[opt.tag] = ast.literal_eval(opt.text)
             else:
-                opt_type = eval(opt.get('type'))
-                if isinstance(opt_type, type):
+                opt_type = xml_types.get(type_attr)
+                if opt_type is not None:
                     xml_args[opt.tag] = opt_type(opt.text)
                 else:
-                    raise ValueError("xml atribute 'type' " + opt.get('type')
+                    raise ValueError("xml atribute 'type' " + type_attr
                                      + " for node " + opt.tag
-                                     + " has to be a valid python type or 'py_eval'")
+                                     + " has to be one of " + ', '.join(xml_types) + " or 'py_eval'")
 
     return xml_args
 
 
+def load_setup(path, keep=None):
+    """Return root element of xml file, only parsing it again if the file was replaced or modified
+
+    If keep is given, only top level nodes whose tag is in keep are retained.
+    The returned tree is shared between calls and must not be modified."""
+
+    st = os.stat(path)
+    return _load_setup(os.path.abspath(path), st.st_mtime_ns, st.st_ino, keep)
+
+@lru_cache(maxsize=32)
+def _load_setup(path, mtime_ns, inode, keep):
+    """Stream parse xml file, dropping top level nodes not in keep as soon as they are read"""
+
+    root = None
+    depth = 0
+    for event, elem in ET.iterparse(path, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 1 and keep is not None and elem.tag not in keep:
+                elem.clear()
+                root.remove(elem)
+    return root
+
+
 def indent_xml(elem, level=0):
+    """Pretty print xml element in place"""
+
+    # Use the C implementation available from python 3.9
+    if hasattr(ET, 'indent'):
+        ET.indent(elem, space="  ", level=level)
+        return
+
     i = "\n" + level*"  "
     if len(elem):
         if not elem.text or not elem.text.strip():